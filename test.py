@@ -10,20 +10,15 @@ root_folder = os.path.abspath(
 )
 sys.path.append(root_folder)  # to enable import from parent directory
 
-import numpy as np
 import torch
+import torchvision
 import tqdm
-from terminaltables import AsciiTable
-from torch.autograd import Variable
 
-# from tools import wandb_logger
 from tools.dataset import HITUAVDatasetTest
 from model import load_model
 from parse_config import parse_data_config
 from utils import ap_per_class
-from utils import get_batch_statistics
 from utils import load_classes
-from utils import non_max_suppression
 from utils import print_environment_info
 from utils import xywh2xyxy
 
@@ -66,17 +61,23 @@ def evaluate_model_file(
     :type verbose: bool, optional
     :return: Returns precision, recall, AP, f1, ap_class
     """
-    workers = 4  # number of workers for loading data in the DataLoader
-    val_dataset = HITUAVDatasetTest(img_path, yolo=True)
-    dataloader = torch.utils.data.DataLoader(
-        val_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        collate_fn=val_dataset.yolo_collate_fn,
-        num_workers=workers,
-        pin_memory=True,
-    )  # note that we're passing the collate function here
+    dataloader = _create_validation_data_loader(
+        img_path, batch_size=batch_size, workers=n_cpu
+    )
     model = load_model(model_path, weights_path)
+    if torch.cuda.is_available():
+        # Batches have a fixed shape, so autotuned conv algorithms get reused
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        # NHWC matches the cuDNN tensor core layout for the conv stack
+        model = model.to(memory_format=torch.channels_last)
+    model = _optimize_model(
+        model,
+        batch_size,
+        img_size,
+        last_batch_size=len(dataloader.dataset) % batch_size,
+    )
     metrics_output = _evaluate(
         model,
         dataloader,
@@ -86,19 +87,171 @@ def evaluate_model_file(
         conf_thres,
         nms_thres,
         verbose,
+        channels_last=torch.cuda.is_available(),
     )
     return metrics_output
 
 
+def _optimize_model(model, batch_size, img_size, last_batch_size=0):
+    """Compile the model for inference.
+    On CUDA the model is compiled with torch.compile in "reduce-overhead" mode,
+    which replays CUDA graphs. CUDA graph trees run the first call eagerly and
+    record on a later one, so every batch shape seen in validation (the full
+    batch and a smaller last batch) is run a few times here to keep compilation
+    and recording out of the validation loop. Without torch.compile (or on CPU)
+    the model is traced with TorchScript instead. Falls back to the eager model
+    if neither works with the Darknet layers.
+    :param model: Model to optimize
+    :type model: models.Darknet
+    :param batch_size: Size of each image batch
+    :type batch_size: int
+    :param img_size: Size of each image dimension for yolo
+    :type img_size: int
+    :param last_batch_size: Size of the smaller last batch, 0 if there is none
+    :type last_batch_size: int, optional
+    :return: Returns the optimized model, or the eager model if that failed
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    example = torch.zeros(batch_size, 3, img_size, img_size, device=device)
+
+    if device.type == "cuda" and hasattr(torch, "compile"):
+        example = example.contiguous(memory_format=torch.channels_last)
+        try:
+            compiled = torch.compile(
+                model, mode="reduce-overhead", fullgraph=False, dynamic=False
+            )
+            with torch.inference_mode(), torch.autocast(
+                device_type=device.type, dtype=torch.float16
+            ):
+                for n in (batch_size, last_batch_size):
+                    if not n:
+                        continue
+                    # compile + eager warm-up, record the graph, then replay it
+                    for _ in range(3):
+                        compiled(example[:n])
+            return compiled
+        except Exception as e:
+            print(f"---- torch.compile failed, trying TorchScript ({e}) ----")
+
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example, strict=False)
+            return torch.jit.optimize_for_inference(traced)
+    except Exception as e:
+        print(f"---- TorchScript tracing failed, using eager model ({e}) ----")
+        return model
+
+
+def non_max_suppression_gpu(
+    prediction, conf_thres=0.25, iou_thres=0.45, max_det=300, max_nms=30000
+):
+    """Performs Non-Maximum Suppression (NMS) on inference results without
+    leaving the device the predictions live on. The whole batch is filtered
+    and suppressed at once by a single nms kernel call, so the host waits on
+    the device a fixed number of times per batch instead of once per image
+    (or, with batched_nms on large inputs, once per image and class).
+    :param prediction: Raw model output of shape (batch, boxes, 5 + classes)
+    :type prediction: torch.Tensor
+    :param conf_thres: Object confidence threshold
+    :type conf_thres: float
+    :param iou_thres: IOU threshold for non-maximum suppression
+    :type iou_thres: float
+    :param max_det: Maximum number of detections kept per image
+    :type max_det: int
+    :param max_nms: Maximum number of boxes per image passed into NMS
+    :type max_nms: int
+    :return: List with one (n, 6) tensor per image [x1, y1, x2, y2, conf, cls]
+    """
+    bs = prediction.shape[0]  # batch size
+    max_wh = 4096  # (pixels) maximum box width and height
+
+    # One detection per (image, box, class) above threshold
+    scores = prediction[..., 5:] * prediction[..., 4:5]  # obj_conf * cls_conf
+    candidates = (prediction[..., 4:5] > conf_thres) & (scores > conf_thres)
+    b, i, j = candidates.nonzero(as_tuple=True)
+    if not len(b):
+        return [prediction.new_zeros((0, 6)) for _ in range(bs)]
+    x = torch.cat(
+        (xywh2xyxy(prediction[b, i, :4]), scores[b, i, j, None], j[:, None].float()),
+        1,
+    )
+
+    if len(b) > max_nms:  # only then can an image exceed the cap
+        # Keep the max_nms highest scoring candidates of each image
+        order = torch.sort(x[:, 4], descending=True, stable=True).indices
+        order = order[torch.sort(b[order], stable=True).indices]
+        counts = torch.bincount(b, minlength=bs)
+        rank = torch.arange(len(order), device=order.device)
+        rank -= (counts.cumsum(0) - counts)[b[order]]
+        order = order[rank < max_nms]
+        b, x = b[order], x[order]
+
+    # Shift boxes by image along x and by class along y, so boxes of different
+    # images or classes never overlap and can share one nms call
+    offsets = torch.stack((b, x[:, 5].long()), 1).repeat(1, 2) * max_wh
+    keep = torchvision.ops.nms(x[:, :4] + offsets, x[:, 4], iou_thres)
+    # Group by image while keeping the descending score order within each image
+    keep = keep[torch.sort(b[keep], stable=True).indices]
+    counts = torch.bincount(b[keep], minlength=bs).tolist()
+    return [detections[:max_det] for detections in x[keep].split(counts)]
+
+
+def get_batch_statistics_vectorized(outputs, targets, iou_threshold):
+    """Compute true positives, scores and labels for a batch of detections.
+    Uses the same greedy matching as utils.get_batch_statistics, but the IoUs
+    of each image are computed by a single box_iou call. Boxes are treated as
+    inclusive pixel ranges (+1 on width and height), like utils.bbox_iou.
+    Apart from one read of the per-image target counts, nothing waits on the
+    device, so the statistics can stay on the GPU until the end of validation.
+    :param outputs: List of per-image detections [x1, y1, x2, y2, conf, cls]
+    :type outputs: [torch.Tensor]
+    :param targets: Targets [image index, class, x1, y1, x2, y2] in pixels
+    :type targets: torch.Tensor
+    :param iou_threshold: IOU threshold required to qualify as detected
+    :type iou_threshold: float
+    :return: Returns true positives, prediction scores and prediction labels
+    """
+    # Group the rows by image for the split below, whatever order they come in
+    targets = targets[torch.sort(targets[:, 0], stable=True).indices]
+    counts = torch.bincount(targets[:, 0].long(), minlength=len(outputs)).tolist()
+
+    true_positives = []
+    for output, annotations in zip(outputs, targets[:, 1:].split(counts)):
+        tp = torch.zeros(len(output), device=output.device)
+        if len(annotations) and len(output):
+            iou = torchvision.ops.box_iou(
+                _inclusive_boxes(output[:, :4]), _inclusive_boxes(annotations[:, 1:])
+            )
+            iou[output[:, -1:] != annotations[None, :, 0]] = -1  # class mismatch
+            best_iou, best_target = iou.max(1)
+            # Detections are sorted by confidence, so each target goes to the
+            # first detection that matches it best above the threshold
+            claims = (best_iou >= iou_threshold)[:, None] & (
+                best_target[:, None]
+                == torch.arange(len(annotations), device=output.device)
+            )
+            # Targets nobody claims point at detection 0 but add nothing
+            tp.scatter_add_(0, claims.int().argmax(0), claims.any(0).float())
+        true_positives.append(tp)
+
+    detections = torch.cat(outputs)
+    return torch.cat(true_positives), detections[:, 4], detections[:, -1]
+
+
+def _inclusive_boxes(boxes):
+    """Shift x2, y2 by one pixel so box_iou follows the +1 area convention."""
+    return torch.cat((boxes[:, :2], boxes[:, 2:] + 1), 1)
+
+
 def print_eval_stats(metrics_output, class_names, verbose):
     if metrics_output is not None:
         precision, recall, AP, f1, ap_class = metrics_output
         if verbose:
             # Prints class AP and mean AP
-            ap_table = [["Index", "Class", "AP"]]
+            print(f"{'Index':>6} {'Class':<20} {'AP':>8}")
             for i, c in enumerate(ap_class):
-                ap_table += [[c, class_names[i], "%.5f" % AP[i]]]
-            print(AsciiTable(ap_table).table)
+                print(f"{c:>6} {class_names[i]:<20} {AP[i]:>8.5f}")
         print(f"---- mAP {AP.mean():.5f} ----")
     else:
         print("---- mAP not measured (no detections found by model) ----")
@@ -113,7 +266,7 @@ def _evaluate(
     conf_thres,
     nms_thres,
     verbose,
-    epoch,
+    channels_last=False,
 ):
     """Evaluate model on validation dataset.
     :param model: Model to evaluate
@@ -132,56 +285,62 @@ def _evaluate(
     :type nms_thres: float
     :param verbose: If True, prints stats of model
     :type verbose: bool
+    :param channels_last: If True, feeds images in channels_last layout; set it
+        only when the model was converted to channels_last, defaults to False
+    :type channels_last: bool, optional
     :return: Returns precision, recall, AP, f1, ap_class
     """
     model.eval()  # Set model to evaluation mode
 
-    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     labels = []
-    sample_metrics = []  # List of tuples (TP, confs, pred)
-    image_list = []  # for wandb slider visualization
-    for batch_i, (imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc="Validating")):
+    tp_list, score_list, label_list = [], [], []  # per-batch TP, confs, pred
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    batches = _prefetch_to_device(dataloader, device, memory_format)
+    for imgs, targets in tqdm.tqdm(batches, total=len(dataloader), desc="Validating"):
         # Extract labels
-        labels += targets[:, 1].tolist()
-        # Rescale target
-        targets[:, 2:] = xywh2xyxy(targets[:, 2:])
-        targets[:, 2:] *= img_size
-
-        imgs = Variable(imgs.type(Tensor), requires_grad=False)
+        labels.append(targets[:, 1])
+        # Rescale target (xywh -> xyxy and scale to pixels in a single pass)
+        cx, cy, w, h = (targets[:, 2:] * img_size).unbind(1)
+        hw, hh = w / 2, h / 2
+        targets[:, 2:] = torch.stack((cx - hw, cy - hh, cx + hw, cy + hh), 1)
 
-        with torch.no_grad():
-            outputs = model(imgs)
-            outputs = non_max_suppression(
-                outputs, conf_thres=conf_thres, iou_thres=nms_thres
+        with torch.inference_mode():
+            # FP16 forward on GPU; NMS below still runs in FP32
+            with torch.autocast(
+                device_type=device.type,
+                dtype=torch.float16,
+                enabled=device.type == "cuda",
+            ):
+                outputs = model(imgs)
+            outputs = non_max_suppression_gpu(
+                outputs.float(), conf_thres=conf_thres, iou_thres=nms_thres
             )
 
-        sample_metrics += get_batch_statistics(
+        true_positives, pred_scores, pred_labels = get_batch_statistics_vectorized(
             outputs, targets, iou_threshold=iou_thres
         )
+        tp_list.append(true_positives)
+        score_list.append(pred_scores)
+        label_list.append(pred_labels)
 
-        # wandb_logger.add_batch(
-        #     images=imgs,
-        #     predictions=outputs,
-        #     ground_truths=[
-        #         targets[targets[:, 0] == image_index][:, 1:]
-        #         for image_index in range(int(targets[0, 0]), int(targets[-1, 0] + 1))
-        #     ],  # change to list of tensor each contain boxes of its image
-        #     class_id_to_label={id: name for id, name in enumerate(class_names)},
-        #     image_list=image_list,
-        #     box_unit="pixel",
-        # )  # add batch to image list before bulk upload
-
-    # wandb_logger.log({"eval/images": image_list, "epoch": epoch})
-
-    if len(sample_metrics) == 0:  # No detections over whole validation set.
+    if len(tp_list) == 0:  # No detections over whole validation set.
         print("---- No detections over whole validation set ----")
         return None
 
     # Concatenate sample statistics
-    true_positives, pred_scores, pred_labels = [
-        np.concatenate(x, 0) for x in list(zip(*sample_metrics))
-    ]
+    labels = torch.cat(labels).cpu().numpy()
+    # Single D2H copy of the statistics accumulated on the device, as one
+    # contiguous float32 array whose rows feed ap_per_class directly
+    true_positives, pred_scores, pred_labels = (
+        torch.stack(
+            (torch.cat(tp_list), torch.cat(score_list), torch.cat(label_list))
+        )
+        .float()
+        .cpu()
+        .numpy()
+    )
     metrics_output = ap_per_class(true_positives, pred_scores, pred_labels, labels)
 
     print_eval_stats(metrics_output, class_names, verbose)
@@ -189,28 +348,85 @@ def _evaluate(
     return metrics_output
 
 
+def _prefetch_to_device(dataloader, device, memory_format=torch.contiguous_format):
+    """Yields the batches of a DataLoader with the images (float32) and targets
+    already on the device. On CUDA the copy of the next batch is queued on a
+    separate stream before the current batch is handed out, so the transfer
+    overlaps the forward pass of the current batch. Pinning stays in the
+    DataLoader's pin_memory thread.
+    :param dataloader: Dataloader provides the batches of images with targets
+    :type dataloader: DataLoader
+    :param device: Device to move the batches to
+    :type device: torch.device
+    :param memory_format: Memory format of the images, matching the model's
+    :type memory_format: torch.memory_format
+    :return: Yields (imgs, targets) on the device
+    """
+    if device.type != "cuda":
+        for imgs, targets in dataloader:
+            imgs = imgs.to(device, dtype=torch.float32, memory_format=memory_format)
+            yield imgs, targets.to(device)
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+
+    def copy(imgs, targets):
+        with torch.cuda.stream(copy_stream):
+            imgs = imgs.to(
+                device,
+                dtype=torch.float32,
+                memory_format=memory_format,
+                non_blocking=True,
+            )
+            targets = targets.to(device, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record(copy_stream)
+        return imgs, targets, done
+
+    def ready(imgs, targets, done):
+        # Wait for this batch's copy only, not the one queued after it
+        stream = torch.cuda.current_stream(device)
+        stream.wait_event(done)
+        imgs.record_stream(stream)  # allocated on copy_stream, used on stream
+        targets.record_stream(stream)
+        return imgs, targets
+
+    pending = None
+    for imgs, targets in dataloader:
+        staged = copy(imgs, targets)
+        if pending is not None:
+            yield ready(*pending)
+        pending = staged
+    if pending is not None:
+        yield ready(*pending)
+
+
 def _create_validation_data_loader(data_folder="./", batch_size=8, workers=4):
     """
     Creates a DataLoader for validation.
-    :param img_path: Path to file containing all paths to validation images.
-    :type img_path: str
+    :param data_folder: Path to the folder containing the validation data
+    :type data_folder: str
     :param batch_size: Size of each image batch
     :type batch_size: int
-    :param img_size: Size of each image dimension for yolo
-    :type img_size: int
-    :param n_cpu: Number of cpu threads to use during batch generation
-    :type n_cpu: int
+    :param workers: Number of cpu threads to use during batch generation
+    :type workers: int
     :return: Returns DataLoader
     :rtype: DataLoader
     """
-    test_dataset = HITUAVDatasetTest(data_folder)
+    test_dataset = HITUAVDatasetTest(data_folder, yolo=True)
+    # Keep workers alive between passes; a deeper prefetch only costs RAM.
+    # DataLoader rejects persistent_workers/prefetch_factor when num_workers == 0
+    worker_kwargs = (
+        dict(persistent_workers=True, prefetch_factor=2) if workers > 0 else {}
+    )
     dataloader = torch.utils.data.DataLoader(
         test_dataset,
         batch_size=batch_size,
-        shuffle=True,
-        collate_fn=test_dataset.collate_fn,
+        shuffle=False,
+        collate_fn=test_dataset.yolo_collate_fn,
         num_workers=workers,
         pin_memory=True,
+        **worker_kwargs,
     )  # note that we're passing the collate function here
     return dataloader
 
@@ -0,0 +1,46 @@
+import ast
+import os
+import types
+
+import pytest
+
+EVALUATION_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.py"
+)
+FUNCTIONS_UNDER_TEST = (
+    "non_max_suppression_gpu",
+    "get_batch_statistics_vectorized",
+    "_inclusive_boxes",
+)
+
+
+def _xywh2xyxy(x):
+    y = x.new(x.shape)
+    y[..., 0] = x[..., 0] - x[..., 2] / 2
+    y[..., 1] = x[..., 1] - x[..., 3] / 2
+    y[..., 2] = x[..., 0] + x[..., 2] / 2
+    y[..., 3] = x[..., 1] + x[..., 3] / 2
+    return y
+
+
+@pytest.fixture(scope="session")
+def evaluation():
+    """Functions under test from test.py, loaded on their own so the parent
+    project (tools, model, parse_config, utils) is not needed to run them.
+    """
+    torch = pytest.importorskip("torch")
+    torchvision = pytest.importorskip("torchvision")
+    with open(EVALUATION_SCRIPT) as f:
+        tree = ast.parse(f.read())
+    functions = [
+        node
+        for node in tree.body
+        if isinstance(node, ast.FunctionDef) and node.name in FUNCTIONS_UNDER_TEST
+    ]
+    namespace = {"torch": torch, "torchvision": torchvision, "xywh2xyxy": _xywh2xyxy}
+    module = ast.Module(body=functions, type_ignores=[])
+    exec(compile(module, EVALUATION_SCRIPT, "exec"), namespace)
+    return types.SimpleNamespace(
+        xywh2xyxy=_xywh2xyxy,
+        **{name: namespace[name] for name in FUNCTIONS_UNDER_TEST},
+    )
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+# Detections [x1, y1, x2, y2, conf, cls], sorted by confidence per image.
+# Covers a duplicate detection, a class mismatch, an image without targets
+# and small boxes whose IoU depends on the +1 pixel area convention.
+OUTPUTS = [
+    [
+        [10.0, 10.0, 20.0, 20.0, 0.9, 0.0],
+        [11.0, 11.0, 21.0, 21.0, 0.8, 0.0],
+        [50.0, 50.0, 53.0, 53.0, 0.7, 1.0],
+        [30.0, 30.0, 40.0, 40.0, 0.6, 1.0],
+        [100.0, 100.0, 102.0, 101.0, 0.5, 0.0],
+    ],
+    [[5.0, 5.0, 15.0, 15.0, 0.4, 0.0]],
+    [[0.0, 0.0, 4.0, 4.0, 0.3, 1.0]],
+]
+# Targets [image index, class, x1, y1, x2, y2]
+TARGETS = [
+    [0.0, 0.0, 10.0, 10.0, 20.0, 20.0],
+    [0.0, 0.0, 30.0, 30.0, 40.0, 40.0],
+    [0.0, 1.0, 51.0, 51.0, 54.0, 54.0],
+    [0.0, 0.0, 101.0, 100.0, 103.0, 101.0],
+    [2.0, 1.0, 1.0, 1.0, 4.0, 4.0],
+]
+EXPECTED_TRUE_POSITIVES = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 1.0]
+
+
+def _batch():
+    return [torch.tensor(output) for output in OUTPUTS], torch.tensor(TARGETS)
+
+
+def test_vectorized_statistics(evaluation):
+    outputs, targets = _batch()
+
+    true_positives, pred_scores, pred_labels = (
+        evaluation.get_batch_statistics_vectorized(outputs, targets, 0.5)
+    )
+
+    assert true_positives.tolist() == EXPECTED_TRUE_POSITIVES
+    assert pred_scores.tolist() == torch.cat(outputs)[:, 4].tolist()
+    assert pred_labels.tolist() == torch.cat(outputs)[:, 5].tolist()
+
+
+def test_vectorized_statistics_unordered_targets(evaluation):
+    outputs, targets = _batch()
+
+    true_positives, _, _ = evaluation.get_batch_statistics_vectorized(
+        outputs, targets.flip(0), 0.5
+    )
+
+    assert true_positives.tolist() == EXPECTED_TRUE_POSITIVES
+
+
+def test_vectorized_statistics_match_utils(evaluation):
+    repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(os.path.dirname(repo_folder))  # utils lives in the parent
+    utils = pytest.importorskip("utils")
+    outputs, targets = _batch()
+
+    expected = utils.get_batch_statistics(outputs, targets, iou_threshold=0.5)
+    true_positives, _, _ = evaluation.get_batch_statistics_vectorized(
+        outputs, targets, 0.5
+    )
+
+    assert true_positives.tolist() == [
+        float(tp) for sample in expected for tp in sample[0]
+    ]
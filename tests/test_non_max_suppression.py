@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+torchvision = pytest.importorskip("torchvision")
+
+BATCH_SIZE = 3
+NUM_CLASSES = 3
+
+
+def _prediction(seed=0):
+    """Random raw model output (batch, boxes, 5 + classes) in pixel units."""
+    generator = torch.Generator().manual_seed(seed)
+    xy = torch.rand(BATCH_SIZE, 200, 2, generator=generator) * 100
+    wh = torch.rand(BATCH_SIZE, 200, 2, generator=generator) * 30 + 1
+    conf = torch.rand(BATCH_SIZE, 200, 1 + NUM_CLASSES, generator=generator)
+    return torch.cat((xy, wh, conf), 2)
+
+
+def _reference_nms(evaluation, prediction, conf_thres, iou_thres, max_nms):
+    """One image at a time, step by step, like utils.non_max_suppression."""
+    output = []
+    for x in prediction:
+        scores = x[:, 5:] * x[:, 4:5]
+        candidates = (x[:, 4:5] > conf_thres) & (scores > conf_thres)
+        i, j = candidates.nonzero(as_tuple=True)
+        detections = torch.cat(
+            (evaluation.xywh2xyxy(x[i, :4]), scores[i, j, None], j[:, None].float()),
+            1,
+        )
+        detections = detections[detections[:, 4].argsort(descending=True)[:max_nms]]
+        keep = torchvision.ops.batched_nms(
+            detections[:, :4], detections[:, 4], detections[:, 5].long(), iou_thres
+        )
+        output.append(detections[keep[:300]])
+    return output
+
+
+def _assert_same_detections(actual, expected):
+    assert len(actual) == len(expected)
+    for image_actual, image_expected in zip(actual, expected):
+        assert image_actual.shape == image_expected.shape
+        assert torch.allclose(image_actual, image_expected)
+
+
+def test_nms_without_candidates(evaluation):
+    output = evaluation.non_max_suppression_gpu(_prediction(), conf_thres=1.0)
+
+    assert [tuple(detections.shape) for detections in output] == [(0, 6)] * 3
+
+
+@pytest.mark.parametrize("max_nms", [30000, 5])
+def test_nms_matches_reference(evaluation, max_nms):
+    prediction = _prediction()
+
+    output = evaluation.non_max_suppression_gpu(
+        prediction, conf_thres=0.3, iou_thres=0.4, max_nms=max_nms
+    )
+
+    if max_nms == 5:  # every image has more candidates than the cap
+        assert all(len(detections) <= 5 for detections in output)
+    _assert_same_detections(
+        output, _reference_nms(evaluation, prediction, 0.3, 0.4, max_nms)
+    )
+
+
+@pytest.mark.parametrize("conf_thres", [0.3, 1.0])
+def test_nms_matches_utils(evaluation, conf_thres):
+    repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(os.path.dirname(repo_folder))  # utils lives in the parent
+    utils = pytest.importorskip("utils")
+    prediction = _prediction()
+
+    output = evaluation.non_max_suppression_gpu(
+        prediction, conf_thres=conf_thres, iou_thres=0.4
+    )
+
+    _assert_same_detections(
+        output,
+        utils.non_max_suppression(
+            prediction.clone(), conf_thres=conf_thres, iou_thres=0.4
+        ),
+    )